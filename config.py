@@ -7,4 +7,13 @@ NORM_IBAN = 'norm_iban'
 NORM_NAME_IBAN = 'norm_name_iban'
 NOT_BUSINESS_TERMS_NAME = 'not_business_terms_name'
 NOT_BUSINESS_TERMS_NAME_NORM_IBAN = 'not_business_terms_iban'
-COMPANY = 'company'
\ No newline at end of file
+COMPANY = 'company'
+STRING_STORAGE = 'pyarrow'
+NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+             '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+BLOCK = 'block'
+IBAN_BLOCKING = 'iban'
+MINHASH_BLOCKING = 'minhash'
+MINHASH_NUM_PERM = 128
+MINHASH_THRESHOLD = 0.8
+PARALLEL_MIN_PAIRS = 5000000
\ No newline at end of file
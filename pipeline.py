@@ -1,112 +1,119 @@
 import pandas as pd
+import polars as pl
+import pyarrow as pa
+import pyarrow.csv as pcsv
 import numpy as np
 import re
+import hashlib
 from cleanco import basename
-from fuzzywuzzy.fuzz import token_set_ratio
+from rapidfuzz import process, fuzz
+from datasketch import MinHash, MinHashLSH
 from pathlib import Path
+from typing import Dict, List, Optional
+from importlib.metadata import version
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
 import argparse
+import multiprocessing
 import os
-from typing import List
 from config import *
 import warnings
 
 
 warnings.filterwarnings('ignore')
 
+PUNCTUATION_PATTERN = r'[^\w\s]'
+SPACES_PATTERN = re.compile(r' +')
 
-def read_data(file_path: Path) -> pd.DataFrame:
+
+def read_data(file_path: Path) -> pl.LazyFrame:
 
     """
-    Read Input CSV as a DataFrame
+    Read Input CSV as a polars LazyFrame. The same tokens that pandas reads as
+    missing values (NA, N/A, NULL, None, nan, among others) are read as nulls.
+    Column types are inferred from every row, and name and IBAN columns are
+    always read as strings.
 
     Args:
         file_path (Path): Path to CSV file
     
     Returns:
-        data (pandas.DataFrame): Data readead and loaded 
+        data (polars.LazyFrame): Data readead, loaded when collected
 
     """
     
     assert file_path.is_file(), "Input file does not exist"
 
-    data = pd.read_csv(file_path)
+    data = pl.scan_csv(file_path, null_values=NA_VALUES, infer_schema_length=None,
+                       schema_overrides={NAME_COLUMN: pl.String, IBAN_COLUMN: pl.String})
     return data
 
 
-def remove_anomaly_data(dataframe: pd.DataFrame) -> pd.DataFrame:
+def remove_anomaly_data(dataframe: pl.LazyFrame) -> pl.LazyFrame:
 
     """
     Remove missing values and invalid IBANs
 
     Args:
-        dataframe (pandas.DataFrame): Dataframe to be cleaned
+        dataframe (polars.LazyFrame): Dataframe to be cleaned
     
     Returns:
-        dataframe (pandas.DataFrame): Dataframe with cleaned data
+        dataframe (polars.LazyFrame): Dataframe with cleaned data
     """
 
-    dataframe.dropna(subset=[NAME_COLUMN, IBAN_COLUMN], inplace=True)
-    dataframe.drop(dataframe.loc[dataframe[IBAN_COLUMN]==INVALID].index, inplace=True)
+    dataframe = dataframe.filter(pl.col(NAME_COLUMN).is_not_null(),
+                                 pl.col(IBAN_COLUMN).is_not_null(),
+                                 pl.col(IBAN_COLUMN) != INVALID)
     return dataframe
 
 
-def normalize_text(text: str) -> str:
-
-    """
-    Normalize text.
-
-    Args:
-        text (str): Text to be normalized
-
-    Returns:
-        text (str): Normalized text
-    """
-
-    text = text.lower()
-    text = re.sub(r'[^\w\s]','', text)
-    text = text.strip()
-    text = re.sub(' +',' ', text)
-    return text
-
-
-def normalize_name_company(dataframe: pd.DataFrame) -> pd.DataFrame:
+def normalize_name_company(dataframe: pl.LazyFrame) -> pl.LazyFrame:
 
     """
-    Normalize name of the Companies.
+    Normalize name of the Companies. It is converted to lower case, punctuation
+    marks and extra white spaces are removed.
 
     Args:
-        dataframe (pandas.DataFrame): Dataframe to be normalized
+        dataframe (polars.LazyFrame): Dataframe to be normalized
 
     Returns:
-        dataframe (pandas.DataFrame): Dataframe with normalized data
+        dataframe (polars.LazyFrame): Dataframe with normalized data
 
     """
 
-    dataframe[NORM_NAME] = dataframe[NAME_COLUMN].apply(lambda x: normalize_text(x))
+    dataframe = dataframe.with_columns(
+        pl.col(NAME_COLUMN).str.to_lowercase()
+                           .str.replace_all(PUNCTUATION_PATTERN, '')
+                           .str.strip_chars()
+                           .str.replace_all(SPACES_PATTERN.pattern, ' ')
+                           .alias(NORM_NAME))
     return dataframe
 
 
-def remove_duplicates(dataframe: pd.DataFrame) -> pd.DataFrame:
+def remove_duplicates(dataframe: pl.LazyFrame) -> pl.LazyFrame:
 
     """
-    Remove duplicates by normalized name and iban
+    Remove duplicates by normalized name and iban, keeping the first one
 
     Args:
-        dataframe (pandas.DataFrame): Dataframe to remove duplicate
+        dataframe (polars.LazyFrame): Dataframe to remove duplicate
 
     Returns:
-        dataframe (pandas.DataFrame): Dataframe with duplicates removed
+        dataframe (polars.LazyFrame): Dataframe with duplicates removed
 
     """
     
-    dataframe.drop_duplicates(subset=[NORM_NAME, IBAN_COLUMN], inplace=True)
+    dataframe = dataframe.unique(subset=[NORM_NAME, IBAN_COLUMN], keep='first', maintain_order=True)
     return dataframe
 
 
 def process_duplicate_removal(file_path: Path) -> pd.DataFrame:
 
     """
-    Apply pipeline process for remove duplicates
+    Apply pipeline process for remove duplicates. The steps are run with the
+    polars streaming engine and the result is converted to pandas through
+    Arrow, so string columns become pyarrow-backed strings without an
+    intermediate copy as Python objects.
 
     Args:
         file_path (Path): CSV file path with the data
@@ -120,6 +127,12 @@ def process_duplicate_removal(file_path: Path) -> pd.DataFrame:
     data = remove_anomaly_data(data)
     data = normalize_name_company(data)
     data = remove_duplicates(data)
+    data = data.collect(engine='streaming').to_arrow()
+    # polars exports large_string, pandas pyarrow-backed strings expect string
+    data = data.cast(pa.schema([pa.field(field.name, pa.string())
+                                if pa.types.is_large_string(field.type) else field
+                                for field in data.schema]))
+    data = data.to_pandas(types_mapper={pa.string(): pd.StringDtype(STRING_STORAGE)}.get)
     return data
 
 
@@ -138,14 +151,15 @@ def remove_business_terms(text: str) -> str:
 
     text = basename(text)
     text = text.strip()
-    text = re.sub(' +',' ', text)
+    text = SPACES_PATTERN.sub(' ', text)
     return text
 
 
 def remove_terms_name_company(dataframe: pd.DataFrame) -> pd.DataFrame:
 
     """
-    Remove business terms from company name column
+    Remove business terms from company name column. Terms are removed once for
+    each unique normalized name and mapped back to each row.
 
     Args:
         dataframe (pandas.DataFrame): Dataframe with the data
@@ -155,32 +169,17 @@ def remove_terms_name_company(dataframe: pd.DataFrame) -> pd.DataFrame:
 
     """
 
-    dataframe[NOT_BUSINESS_TERMS_NAME] = dataframe[NORM_NAME].apply(remove_business_terms)
+    unique_names = pd.unique(dataframe[NORM_NAME])
+    names_without_terms = {name: remove_business_terms(name) for name in unique_names}
+    dataframe[NOT_BUSINESS_TERMS_NAME] = dataframe[NORM_NAME].map(names_without_terms) \
+                                                             .astype(dataframe[NORM_NAME].dtype)
     return dataframe
 
 
-def remove_last_digits_iban(iban: str) -> str:
-
-    """
-    Remove last two digits of the IBAN
-
-    Args:
-        iban (str): Complete IBAN
-
-    Return:
-        iban (str): IBAN without last two digits
-    """
-
-    iban = re.sub(' +','', iban)
-    iban = iban[:-2]
-    iban = iban.strip()
-    return iban
-
-
 def generate_name_iban_normalized(dataframe: pd.DataFrame) -> pd.DataFrame:
 
     """
-    Generate columns with the IBAN without last 2 digits, join the normalized name and iban
+    Generate columns with the IBAN without white spaces and last 2 digits, join the normalized name and iban
     and generate column with name without business terms and iban processed.
 
     Args:
@@ -190,10 +189,11 @@ def generate_name_iban_normalized(dataframe: pd.DataFrame) -> pd.DataFrame:
         dataframe (pandas.DataFrame): Dataframe with the processed data
     """
 
-    dataframe[NORM_IBAN] = dataframe[IBAN_COLUMN].apply(remove_last_digits_iban)
-    dataframe[NORM_NAME_IBAN] = dataframe[NORM_NAME] + ' ' + dataframe[IBAN_COLUMN]
+    dataframe[NORM_IBAN] = dataframe[IBAN_COLUMN].str.replace(' ', '', regex=False) \
+                                                 .str.slice(0, -2)
+    dataframe[NORM_NAME_IBAN] = dataframe[NORM_NAME].str.cat(dataframe[IBAN_COLUMN], sep=' ')
     dataframe[NOT_BUSINESS_TERMS_NAME_NORM_IBAN] = \
-        dataframe[NOT_BUSINESS_TERMS_NAME] + ' ' + dataframe[NORM_IBAN]
+        dataframe[NOT_BUSINESS_TERMS_NAME].str.cat(dataframe[NORM_IBAN], sep=' ')
     return dataframe
 
 
@@ -213,45 +213,173 @@ def get_uniques_name_plus_iban(dataframe: pd.DataFrame) -> np.array:
     return name_iban_norm_uniques
 
 
-def get_company_match(actual_company: str, unique_companies: List[str]) -> str:
+def generate_iban_block(dataframe: pd.DataFrame) -> pd.DataFrame:
+
+    """
+    Generate block column with the iban processed, so each name is only
+    compared with candidates sharing its iban.
+
+    Args:
+        dataframe (pandas.DataFrame): Dataframe with the data
+
+    Returns:
+        dataframe (pandas.DataFrame): Dataframe with the block column
+    """
+
+    dataframe[BLOCK] = dataframe[NORM_IBAN]
+    return dataframe
+
+
+def get_minhash(text: str) -> MinHash:
+
+    """
+    Get MinHash signature from the word 2-shingles of a text. Texts with a
+    single word use the word itself.
+
+    Args:
+        text (str): Text to be hashed
+
+    Returns:
+        minhash (MinHash): MinHash signature of the text
+    """
+
+    words = text.split()
+    shingles = [' '.join(words[i:i + 2]) for i in range(max(len(words) - 1, 1))]
+    minhash = MinHash(num_perm=MINHASH_NUM_PERM)
+    for shingle in shingles:
+        minhash.update(shingle.encode('utf8'))
+    return minhash
+
+
+def generate_minhash_block(dataframe: pd.DataFrame) -> pd.DataFrame:
+
+    """
+    Generate block column by clustering the names without business terms with
+    MinHash LSH, so each name is only compared with candidates with a similar
+    name, regardless of the iban.
+
+    Args:
+        dataframe (pandas.DataFrame): Dataframe with the data
+
+    Returns:
+        dataframe (pandas.DataFrame): Dataframe with the block column
+    """
+
+    names = pd.unique(dataframe[NOT_BUSINESS_TERMS_NAME])
+    lsh = MinHashLSH(threshold=MINHASH_THRESHOLD, num_perm=MINHASH_NUM_PERM)
+    minhashes = {}
+    for name in names:
+        minhashes[name] = get_minhash(name)
+        lsh.insert(name, minhashes[name])
+
+    clusters = {name: name for name in names}
+
+    def find(name):
+        while clusters[name] != name:
+            clusters[name] = clusters[clusters[name]]
+            name = clusters[name]
+        return name
+
+    for name in names:
+        for candidate in lsh.query(minhashes[name]):
+            clusters[find(candidate)] = find(name)
+
+    dataframe[BLOCK] = dataframe[NOT_BUSINESS_TERMS_NAME].map({name: find(name) for name in names})
+    return dataframe
+
+
+def get_blocks(dataframe: pd.DataFrame) -> Dict[str, np.array]:
 
     """
-    Get the highest match score (levenshtein distance) between a normalized
-    name plus iban and the unique names without terms concataned with iban
-    processed.
+    Group the unique names without terms concataned with iban processed by
+    block.
 
     Args:
-        actual_company (str): Name to be matched
-        unique_companies (List[str]): List of unique names without terms concataned with iban
+        dataframe (pandas.DataFrame): Dataframe with the data
 
     Returns:
-        match (str): Name without terms with the highest match score
-            
+        blocks (Dict[str, np.array]): Unique values for each block
     """
 
-    match_values = []
-    for unique_company in unique_companies:
-        match_score = token_set_ratio(unique_company, actual_company)
-        match_values.append(match_score)
-    company = unique_companies[np.array(match_values).argmax()].split()[:-1]
-    return ' '.join(company).capitalize()
+    uniques = dataframe.drop_duplicates(subset=[NOT_BUSINESS_TERMS_NAME_NORM_IBAN])
+    blocks = {block: group.to_numpy() for block, group in
+              uniques.groupby(BLOCK, sort=False)[NOT_BUSINESS_TERMS_NAME_NORM_IBAN]}
+    return blocks
 
 
-def generate_company_match(dataframe: pd.DataFrame, unique_company_name_iban) -> pd.DataFrame:
+def get_block_match(queries: List[str], candidates: np.array) -> np.array:
 
     """
-    Process company match for entire dataset
+    Get the candidate with the highest match score (token set ratio) for each
+    normalized name plus iban of a block. Blocks with a single candidate are
+    not scored.
+
+    Args:
+        queries (List[str]): Normalized names plus iban of the block
+        candidates (np.array): Unique names without terms concataned with iban of the block
+
+    Returns:
+        match (np.array): Candidate with the highest match score for each query
+    """
+
+    if len(candidates) == 1:
+        return np.repeat(candidates, len(queries))
+
+    scores = process.cdist(queries,
+                           candidates.tolist(),
+                           scorer=fuzz.token_set_ratio,
+                           dtype=np.uint8)
+    return candidates[scores.argmax(axis=1)]
+
+
+def generate_company_match(dataframe: pd.DataFrame, unique_company_name_iban: np.array,
+                           blocks: Dict[str, np.array]) -> pd.DataFrame:
+
+    """
+    Process company match for entire dataset. Scores every unique normalized
+    name plus iban against the unique names without terms concataned with iban
+    processed (token set ratio) in the same block, and maps the best match
+    back to each row. Every block has candidates, since queries and candidates
+    come from the same rows. Blocks are scored in the current process, or in
+    parallel across spawned processes when there are several CPUs and enough
+    pairs to score to pay for starting them. The company name displayed is
+    computed once for each unique value.
 
     Args:
         dataframe (pandas.DataFrame): Dataframe with the data
-        unique_company_name_iban (List[str]): List of unique names without terms concataned with iban
+        unique_company_name_iban (np.array): Array of unique names without terms concataned with iban
+        blocks (Dict[str, np.array]): Unique names without terms concataned with iban by block
 
     Returns:
         dataframe (pandas.DataFrame): Dataframe with the data
     """
 
-    dataframe[COMPANY] = dataframe[NORM_NAME_IBAN].apply(lambda x: 
-                                                         get_company_match(x,unique_company_name_iban))
+    queries = dataframe.drop_duplicates(subset=[NORM_NAME_IBAN])
+    groups = list(queries.groupby(BLOCK, sort=False)[NORM_NAME_IBAN])
+    query_blocks = [group.tolist() for _, group in groups]
+    candidate_blocks = [blocks[block] for block, _ in groups]
+
+    workers = os.cpu_count() or 1
+    pairs = sum(len(query_block) * len(candidate_block)
+                for query_block, candidate_block in zip(query_blocks, candidate_blocks)
+                if len(candidate_block) > 1)
+    if workers > 1 and pairs > PARALLEL_MIN_PAIRS:
+        # Spawn instead of fork: polars has already started its thread pool
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            best_match = executor.map(get_block_match, query_blocks, candidate_blocks,
+                                      chunksize=max(1, len(query_blocks) // (workers * 4)))
+            best_match = list(chain.from_iterable(best_match))
+    else:
+        best_match = list(chain.from_iterable(map(get_block_match, query_blocks, candidate_blocks)))
+
+    display_names = pd.Series(unique_company_name_iban, dtype=object)
+    display_names = display_names.str.rsplit(' ', n=1).str[0].str.capitalize()
+    display_names = dict(zip(unique_company_name_iban, display_names))
+
+    unique_queries = chain.from_iterable(query_blocks)
+    mapping = {query: display_names[match] for query, match in zip(unique_queries, best_match)}
+    dataframe[COMPANY] = dataframe[NORM_NAME_IBAN].map(mapping)
     return dataframe
 
 
@@ -266,29 +394,108 @@ def generate_group_by_company(dataframe: pd.DataFrame) -> pd.DataFrame:
         dataframe (pandas.DataFrame): Grouped data by final company
     """
 
-    data = dataframe.groupby(COMPANY).agg({NAME_COLUMN:lambda x: list(set(x)),
-                                           IBAN_COLUMN:lambda x: list(set(x))})
+    data = dataframe.groupby(COMPANY).agg({NAME_COLUMN: 'unique',
+                                           IBAN_COLUMN: 'unique'})
+    data[NAME_COLUMN] = data[NAME_COLUMN].map(list)
+    data[IBAN_COLUMN] = data[IBAN_COLUMN].map(list)
     
     return data
 
 
-def process_entity_resolution(dataframe: pd.DataFrame) -> pd.DataFrame:
+def get_match_cache_path(dataframe: pd.DataFrame, blocking: str, cache_folder: Path) -> Path:
+
+    """
+    Get the path of the cached company match, keyed by a hash of the
+    normalized names and ibans, the blocking strategy, the MinHash settings
+    and the versions of the packages that affect the match.
+
+    Args:
+        dataframe (pandas.DataFrame): Dataframe with the data without duplicates
+        blocking (str): Blocking strategy for the company match
+        cache_folder (Path): Folder with the cached company matches
+
+    Returns:
+        cache_path (Path): Path of the cached company match
+    """
+
+    key = hashlib.sha1(pd.util.hash_pandas_object(dataframe[[NORM_NAME, IBAN_COLUMN]],
+                                                  index=False).values)
+    settings = f'{blocking}-{MINHASH_THRESHOLD}-{MINHASH_NUM_PERM}' \
+               f'-cleanco{version("cleanco")}-rapidfuzz{version("rapidfuzz")}' \
+               f'-datasketch{version("datasketch")}'
+    key.update(settings.encode('utf8'))
+    return cache_folder / f'{key.hexdigest()}.parquet'
+
+
+def read_company_match(dataframe: pd.DataFrame, cache_path: Path) -> pd.DataFrame:
+
+    """
+    Assign the company of each row from a cached company match
+
+    Args:
+        dataframe (pandas.DataFrame): Dataframe with the data
+        cache_path (Path): Path of the cached company match
+
+    Returns:
+        dataframe (pandas.DataFrame): Dataframe with the data
+    """
+
+    matches = pd.read_parquet(cache_path)
+    mapping = dict(zip(matches[NORM_NAME_IBAN], matches[COMPANY]))
+    dataframe[COMPANY] = dataframe[NORM_NAME_IBAN].map(mapping)
+    return dataframe
+
+
+def write_company_match(dataframe: pd.DataFrame, cache_path: Path) -> None:
+
+    """
+    Cache the company assigned to each normalized name plus iban
+
+    Args:
+        dataframe (pandas.DataFrame): Dataframe with the data
+        cache_path (Path): Path of the cached company match
+    """
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    matches = dataframe[[NORM_NAME_IBAN, COMPANY]].drop_duplicates(subset=[NORM_NAME_IBAN])
+    matches.to_parquet(cache_path, index=False)
+
+
+def process_entity_resolution(dataframe: pd.DataFrame, blocking: str = IBAN_BLOCKING,
+                              cache_folder: Optional[Path] = None) -> pd.DataFrame:
 
     """
-    Apply pipeline process for entity resolution
+    Apply pipeline process for entity resolution. If a cache folder is given,
+    the company match is read from it when the same data was already
+    processed with the same settings.
     
     Args:
         dataframe (pandas.DataFrame): Dataframe with the data without duplicates
+        blocking (str): Blocking strategy for the company match, iban or minhash
+        cache_folder (Optional[Path]): Folder with the cached company matches, None to disable the cache
 
     Returns:
         dataframe (pandas.DataFrame): Dataframe with entity resolution
 
     """
 
+    cache_path = None
+    if cache_folder is not None:
+        cache_path = get_match_cache_path(dataframe, blocking, cache_folder)
     dataframe = remove_terms_name_company(dataframe)
     dataframe = generate_name_iban_normalized(dataframe)
-    uniques_name_plus_iban = get_uniques_name_plus_iban(dataframe)
-    dataframe = generate_company_match(dataframe, uniques_name_plus_iban)
+    if cache_path is not None and cache_path.is_file():
+        dataframe = read_company_match(dataframe, cache_path)
+    else:
+        if blocking == MINHASH_BLOCKING:
+            dataframe = generate_minhash_block(dataframe)
+        else:
+            dataframe = generate_iban_block(dataframe)
+        uniques_name_plus_iban = get_uniques_name_plus_iban(dataframe)
+        blocks = get_blocks(dataframe)
+        dataframe = generate_company_match(dataframe, uniques_name_plus_iban, blocks)
+        if cache_path is not None:
+            write_company_match(dataframe, cache_path)
     result_dataframe = generate_group_by_company(dataframe)
     return result_dataframe
 
@@ -299,6 +506,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser('Substitution Process')
     parser.add_argument('-f', '--input_file', type=str, required=True)
     parser.add_argument('-o', '--output_folder', type=str, required=True)
+    parser.add_argument('-b', '--blocking', type=str, default=IBAN_BLOCKING,
+                        choices=[IBAN_BLOCKING, MINHASH_BLOCKING])
+    parser.add_argument('-c', '--cache_folder', type=str, default=None)
     args = parser.parse_args()
 
     input_file = Path(args.input_file)
@@ -308,10 +518,12 @@ if __name__ == "__main__":
 
     data_duplicate_removal = process_duplicate_removal(file_path=input_file)
     duplicate_removal_path = os.path.join(output_folder, 'duplicate_removal_output.csv')
-    data_duplicate_removal.to_csv(duplicate_removal_path,
-                                                              index=False)
+    pcsv.write_csv(pa.Table.from_pandas(data_duplicate_removal, preserve_index=False),
+                   duplicate_removal_path)
     
-    data_entity_resolution = process_entity_resolution(dataframe=data_duplicate_removal)
+    data_entity_resolution = process_entity_resolution(dataframe=data_duplicate_removal,
+                                                       blocking=args.blocking,
+                                                       cache_folder=Path(args.cache_folder) if args.cache_folder else None)
     entity_resolution_path = os.path.join(output_folder, 'entity_resolution_output.csv')
     data_entity_resolution.to_csv(entity_resolution_path)
 